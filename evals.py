@@ -1,26 +1,64 @@
 # backend/app/services/evals.py
 
 import os
+import json
 import asyncio
+import functools
+import hashlib
 import pandas as pd
 from dotenv import load_dotenv
+from pydantic import BaseModel
 
-# Load environment variables from .env
-load_dotenv()
+from services.excel_export import excel_writer, write_sheet
 
-from api.queries import main as handle_query, fetch_context
-from models.entities import UserQuestionRequest
-from phoenix.evals import (
-    SQL_GEN_EVAL_PROMPT_TEMPLATE,
-    SQL_GEN_EVAL_PROMPT_RAILS_MAP,
-    QA_PROMPT_TEMPLATE,
-    QA_PROMPT_RAILS_MAP,
-    LiteLLMModel,
-    llm_classify
-)
+# v2 deprecates .dict() in favour of model_dump(); resolve which API to use
+# once instead of probing every response.
+_PYDANTIC_V2 = hasattr(BaseModel, "model_dump")
+
+if _PYDANTIC_V2:
+    def _to_dict(resp) -> dict:
+        return resp if isinstance(resp, dict) else resp.model_dump(mode="python")
+else:
+    def _to_dict(resp) -> dict:
+        return resp if isinstance(resp, dict) else resp.dict()
+
+
+@functools.lru_cache(maxsize=None)
+def _lazy_setup():
+    """
+    Load .env and the pipeline / Phoenix imports on first use. Phoenix pulls
+    in OpenAI, LiteLLM, pyarrow, etc., so importing this module stays cheap.
+    """
+    global handle_query, fetch_context, _build_request
+    global SQL_GEN_EVAL_PROMPT_TEMPLATE, SQL_GEN_EVAL_PROMPT_RAILS_MAP
+    global QA_PROMPT_TEMPLATE, QA_PROMPT_RAILS_MAP, LiteLLMModel, llm_classify
+    global pa
+
+    # Load environment variables from .env
+    load_dotenv()
+
+    import pyarrow as pa
+
+    from api.queries import main as handle_query, fetch_context
+    from models.entities import UserQuestionRequest
+    from phoenix.evals import (
+        SQL_GEN_EVAL_PROMPT_TEMPLATE,
+        SQL_GEN_EVAL_PROMPT_RAILS_MAP,
+        QA_PROMPT_TEMPLATE,
+        QA_PROMPT_RAILS_MAP,
+        LiteLLMModel,
+        llm_classify
+    )
+
+    # Requests are built from our own eval cases, so skip validation
+    if _PYDANTIC_V2:
+        _build_request = UserQuestionRequest.model_construct
+    else:
+        _build_request = UserQuestionRequest.construct
+
+_DUMMY_AUTH = {"sub": "eval_user", "roles": ["evaluator"]}
 
 # === Hard-coded evaluation cases ===
-USE_HARDCODE = os.getenv("USE_HARDCODE_EXAMPLES", "false").lower() == "true"
 TEST_EVAL_CASES = [
     {
         "Question": "How many users signed up last month?",  
@@ -42,99 +80,383 @@ TEST_EVAL_CASES = [
     },
 ]
 
-if USE_HARDCODE:
-    eval_df = pd.DataFrame(TEST_EVAL_CASES)
-else:
-    raise RuntimeError("USE_HARDCODE_EXAMPLES must be true to use hard-coded cases")
+# === Eval dataset on disk ===
+EVAL_COLUMNS = ["Question", "GroundTruthSQL", "GroundTruthResponse"]
+
+def _read_dataset(path: str) -> pd.DataFrame:
+    """Load eval cases from .parquet, .csv or .xlsx, parsing only the columns we use."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".parquet":
+        return pd.read_parquet(path, columns=EVAL_COLUMNS)
+    if ext == ".csv":
+        return pd.read_csv(path, usecols=EVAL_COLUMNS, engine="pyarrow")
+    # python-calamine parses .xlsx an order of magnitude faster than openpyxl;
+    # for big datasets, convert to parquet once and point at that instead.
+    return pd.read_excel(path, usecols=EVAL_COLUMNS, engine="calamine")
+
+def load_eval_cases() -> pd.DataFrame:
+    use_hardcode = os.getenv("USE_HARDCODE_EXAMPLES", "false").lower() == "true"
+    if use_hardcode:
+        return pd.DataFrame(TEST_EVAL_CASES)
+    dataset_path = os.getenv("EVAL_DATASET_PATH")
+    if not dataset_path:
+        raise RuntimeError(
+            "Set USE_HARDCODE_EXAMPLES=true or point EVAL_DATASET_PATH at an eval dataset"
+        )
+    return _read_dataset(dataset_path)
 
 # === Step 1: Run through Conversational BI pipeline ===
-async def run_pipeline(df: pd.DataFrame) -> pd.DataFrame:
-    dummy_auth = {"sub": "eval_user", "roles": ["evaluator"]}
-    records = []
-    for _, row in df.iterrows():
-        q = row["Question"]
-        ctx = await fetch_context(q)
-        user_ctx = str(ctx) if ctx is not None else None
-        req = UserQuestionRequest(user_question=q, user_context=user_ctx)
-        resp = await handle_query(req, auth=dummy_auth)
-        out = resp.dict() if hasattr(resp, "dict") else dict(resp)
-        records.append({
+# Question -> fetch_context future; duplicate questions share a single fetch,
+# including ones that are still in flight under gather().
+_CTX_CACHE: dict[str, asyncio.Future] = {}
+
+async def _cached_context(q: str):
+    fut = _CTX_CACHE.get(q)
+    if fut is None:
+        fut = _CTX_CACHE[q] = asyncio.ensure_future(fetch_context(q))
+    try:
+        return await fut
+    except Exception:
+        # Don't pin a failed fetch; the next duplicate retries it. Only evict
+        # our own future, not a newer fetch another duplicate has started.
+        if _CTX_CACHE.get(q) is fut:
+            del _CTX_CACHE[q]
+        raise
+
+# With EVAL_CONTEXT_CACHE=1, fetched contexts are also saved between runs.
+# Lookups are by exact question text, so a near-duplicate question never
+# borrows another question's context.
+CONTEXT_CACHE_PATH = os.path.join(os.path.dirname(__file__), "eval_context_cache.json")
+
+def _restore_contexts(path: str):
+    """Seed _CTX_CACHE with contexts saved by a previous run."""
+    if not os.path.exists(path):
+        return
+    with open(path, encoding="utf-8") as f:
+        saved = json.load(f)
+    loop = asyncio.get_running_loop()
+    for q, ctx in saved.items():
+        if q not in _CTX_CACHE:
+            fut = _CTX_CACHE[q] = loop.create_future()
+            fut.set_result(ctx)
+
+def _persist_contexts(path: str):
+    saved = {}
+    for q, fut in _CTX_CACHE.items():
+        if fut.done() and not fut.cancelled() and fut.exception() is None:
+            ctx = fut.result()
+            saved[q] = str(ctx) if ctx is not None else None
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(saved, f, ensure_ascii=False)
+
+def _request_pacer(rpm: int):
+    """
+    Return an async ``wait()`` that spaces calls so at most ``rpm`` start per
+    minute. Throttling up front avoids 429s and the retry storms they cause.
+    """
+    interval = 60.0 / rpm
+    next_slot = 0.0
+
+    async def wait():
+        nonlocal next_slot
+        now = asyncio.get_running_loop().time()
+        start = max(now, next_slot)
+        next_slot = start + interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    return wait
+
+# With EVAL_USE_CACHE=1, pipeline responses are kept in a diskcache store so
+# re-running the eval after unrelated changes skips the LLM calls. Only
+# meaningful while the pipeline runs deterministically (temperature 0).
+RESPONSE_CACHE_DIR = os.path.join(os.path.dirname(__file__), ".eval_cache")
+
+def _response_key(q: str, user_ctx) -> str:
+    payload = {"q": q, "ctx": user_ctx, "model": os.getenv("AZURE_OPENAI_CHAT_MODEL")}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+# Completed predictions are appended here as they finish. A fresh run starts
+# it over; with EVAL_RESUME=1 an interrupted run picks up the rows it left
+# behind instead. The file is removed once the report has been written.
+PREDICTIONS_PATH = os.path.join(os.path.dirname(__file__), "eval_predictions.jsonl")
+
+def _load_predictions(path: str) -> dict:
+    """Read successful predictions left behind by an interrupted run, keyed by row."""
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # torn last line from a crash
+            if rec.get("Error") is None:
+                done[rec["Row"]] = rec
+    return done
+
+async def run_pipeline(df: pd.DataFrame, predictions_path: str = PREDICTIONS_PATH) -> pd.DataFrame:
+    _lazy_setup()
+    persist_contexts = os.getenv("EVAL_CONTEXT_CACHE", "0") == "1"
+    if persist_contexts:
+        _restore_contexts(CONTEXT_CACHE_PATH)
+    else:
+        # Contexts go stale between runs; only reuse them across runs (in a
+        # notebook or watch loop) when persistence was asked for
+        _CTX_CACHE.clear()
+    # Optional requests-per-minute cap on pipeline (LLM) calls
+    rpm = int(os.getenv("EVAL_RPM", "0"))
+    pace = _request_pacer(rpm) if rpm > 0 else None
+    responses = None
+    if os.getenv("EVAL_USE_CACHE", "0") == "1":
+        import diskcache
+        responses = diskcache.Cache(RESPONSE_CACHE_DIR)
+
+    async def run_one(i: int, q) -> dict:
+        rec = {
+            "Row": i,
             "Question": q,
-            "UserContext": user_ctx,
-            "GeneratedSQL": out.get("final_sql") or out.get("sql_query"),
-            "GeneratedResponse": out.get("query_execution_response") or out.get("rows"),
-            "GroundTruthSQL": row.get("GroundTruthSQL"),
-            "GroundTruthResponse": row.get("GroundTruthResponse"),
-        })
-    return pd.DataFrame(records)
+            "UserContext": None,
+            "GeneratedSQL": None,
+            "GeneratedResponse": None,
+            "Error": None,
+        }
+        try:
+            ctx = await _cached_context(q)
+            rec["UserContext"] = str(ctx) if ctx is not None else None
+            key = _response_key(q, rec["UserContext"]) if responses is not None else None
+            out = responses.get(key) if responses is not None else None
+            if out is None:
+                req = _build_request(user_question=q, user_context=rec["UserContext"])
+                if pace is not None:
+                    await pace()
+                out = _to_dict(await handle_query(req, auth=_DUMMY_AUTH))
+                if responses is not None:
+                    responses[key] = out
+        except Exception as err:
+            # One failing case must not cancel the rest of the batch
+            rec["Error"] = str(err)
+            return rec
+        rec["GeneratedSQL"] = out.get("final_sql") or out.get("sql_query")
+        rec["GeneratedResponse"] = out.get("query_execution_response") or out.get("rows")
+        return rec
 
-pred_df = asyncio.run(run_pipeline(eval_df))
+    questions = df["Question"].tolist()
+    # Resuming is opt-in: saved rows skip the pipeline entirely, so a stale
+    # sidecar would silently hide the pipeline changes an eval is rerun for.
+    # Only trust a saved row if it still lines up with the same question.
+    resume = os.getenv("EVAL_RESUME", "0") == "1"
+    done = {
+        i: rec for i, rec in _load_predictions(predictions_path).items()
+        if i < len(questions) and rec["Question"] == questions[i]
+    } if resume else {}
+    if done:
+        print(f"Resuming {len(done)} of {len(questions)} rows from {predictions_path}")
+
+    # Row whose prediction each row reports. With EVAL_DEDUPE=1 a repeated
+    # question reuses the result from its first occurrence; it is opt-in
+    # because the LLM pipeline is not deterministic.
+    if os.getenv("EVAL_DEDUPE", "0") == "1":
+        first_row = {}
+        source = [first_row.setdefault(q, i) for i, q in enumerate(questions)]
+    else:
+        source = list(range(len(questions)))
+    queue = asyncio.Queue()
+    for i in sorted(set(source)):
+        if i not in done:
+            queue.put_nowait(i)
+
+    # Cases are independent, I/O-bound pipeline calls. A fixed pool of
+    # EVAL_CONCURRENCY workers pulls from the queue, so a fast case frees
+    # its slot for the next one immediately while slow ones keep running,
+    # and we stay under upstream rate limits.
+    async def worker(sink):
+        while not queue.empty():
+            i = queue.get_nowait()
+            rec = await run_one(i, questions[i])
+            line = json.dumps(rec, ensure_ascii=False, default=str)
+            sink.write(line + "\n")
+            sink.flush()
+            # When resuming, keep fresh rows in the same JSON-decoded form as
+            # the resumed ones so the report's column types don't mix
+            done[i] = json.loads(line) if resume else rec
+
+    with open(predictions_path, "a" if resume else "w", encoding="utf-8") as sink:
+        workers = int(os.getenv("EVAL_CONCURRENCY", "8"))
+        await asyncio.gather(*(worker(sink) for _ in range(workers)))
+
+    if persist_contexts:
+        _persist_contexts(CONTEXT_CACHE_PATH)
+    if responses is not None:
+        responses.close()
+
+    # Assemble the frame column-wise; cheaper than a list of per-row dicts.
+    # Text columns are Arrow-backed, which is far lighter than object dtype;
+    # the response payloads are nested rows and stay as Python objects.
+    records = [done[i] for i in source]
+    text = pd.ArrowDtype(pa.string())
+    return pd.DataFrame({
+        "Question": pd.array(questions, dtype=text),
+        "UserContext": pd.array([r["UserContext"] for r in records], dtype=text),
+        "GeneratedSQL": pd.array([r["GeneratedSQL"] for r in records], dtype=text),
+        "GeneratedResponse": [r["GeneratedResponse"] for r in records],
+        "GroundTruthSQL": df["GroundTruthSQL"].astype(text).array,
+        "GroundTruthResponse": df["GroundTruthResponse"].to_numpy(),
+        "Error": pd.array([r["Error"] for r in records], dtype=text),
+    })
 
 # === Step 2: Evaluate with Arize Phoenix (Ollama only) ===
-# Prepare DataFrames for SQL correctness eval
-sql_df = pred_df[["Question", "GeneratedSQL", "GroundTruthSQL"]].rename(
-    columns={"Question": "instruction", "GeneratedSQL": "predicted_sql", "GroundTruthSQL": "ground_truth_sql"}
-)
-# Prepare DataFrames for response correctness eval
-resp_df = pred_df[["Question", "GeneratedResponse", "GroundTruthResponse"]].rename(
-    columns={"Question": "instruction", "GeneratedResponse": "predicted_response", "GroundTruthResponse": "ground_truth_response"}
-)
-
-# Instantiate Ollama model only
-ollama_model = LiteLLMModel(model=os.getenv("OLLAMA_MODEL", "ollama/llama3.2-vision:11b"))
-
-rails_sql = list(SQL_GEN_EVAL_PROMPT_RAILS_MAP.values())
-rails_qa = list(QA_PROMPT_RAILS_MAP.values())
-
-# SQL evaluation (Ollama only)
-sql_res_ollama = llm_classify(
-    dataframe=sql_df,
-    template=SQL_GEN_EVAL_PROMPT_TEMPLATE,
-    model=ollama_model,
-    rails=rails_sql,
-    provide_explanation=True,
-)
-# Response evaluation (Ollama only)
-resp_res_ollama = llm_classify(
-    dataframe=resp_df,
-    template=QA_PROMPT_TEMPLATE,
-    model=ollama_model,
-    rails=rails_qa,
-    provide_explanation=True,
-)
-
-# Merge labels back into pred_df
-result_df = pred_df.copy()
-result_df["label_sql_ollama"] = sql_res_ollama["label"]
-result_df["explanation_sql_ollama"] = sql_res_ollama["explanation"]
-result_df["label_resp_ollama"] = resp_res_ollama["label"]
-result_df["explanation_resp_ollama"] = resp_res_ollama["explanation"]
-
-# === Step 3: Output ===
-print("\n===== Detailed Evaluation Results (Ollama only) =====")
-print(result_df.to_string(index=False))
-
-# Aggregate metrics (Ollama only)
-metrics = {}
-metrics['Ollama SQL'] = sql_res_ollama.metrics()
-metrics['Ollama Resp'] = resp_res_ollama.metrics()
-print("\n===== Aggregate Metrics =====")
-for key, met in metrics.items():
-    print(f"-- {key} --")
-    for k, v in met.items(): print(f"{k:30s}: {v}")
-    print()
-
-# Excel export
-out_path = os.path.join(os.path.dirname(__file__), "eval_results_ollama.xlsx")
-with pd.ExcelWriter(out_path, engine="openpyxl") as writer:
-    result_df.to_excel(writer, sheet_name="Detailed", index=False)
-    sum_rows = []
-    for key, met in metrics.items():
-        for k, v in met.items():
-            sum_rows.append((f"{key}: {k}", v))
-    pd.DataFrame(sum_rows, columns=["Metric","Value"]).to_excel(
-        writer, sheet_name="Summary", index=False
+@functools.lru_cache(maxsize=None)
+def _get_ollama_model(max_tokens=None):
+    _lazy_setup()
+    # Built on first use and reused for the life of the process, so reruns
+    # from a notebook or watch loop don't redo the model setup.
+    kwargs = {} if max_tokens is None else {"max_tokens": max_tokens}
+    return LiteLLMModel(model=os.getenv("OLLAMA_MODEL", "ollama/llama3.2-vision:11b"), **kwargs)
+
+def _classify(df: pd.DataFrame, template, rails_map: dict, model, label_model,
+              concurrency: int, explain_failures_only: bool) -> pd.DataFrame:
+    rails = list(rails_map.values())
+    if not explain_failures_only:
+        return llm_classify(
+            dataframe=df,
+            template=template,
+            model=model,
+            rails=rails,
+            provide_explanation=True,
+            concurrency=concurrency,
+        )
+
+    # Cheap first pass for labels only, then ask for explanations just on
+    # the rows that didn't pass; most rows never pay for explanation tokens.
+    res = llm_classify(
+        dataframe=df,
+        template=template,
+        model=label_model,
+        rails=rails,
+        provide_explanation=False,
+        concurrency=concurrency,
+    )
+    res["explanation"] = None
+    retry = (res["label"] != rails_map[True]).to_numpy()
+    if retry.any():
+        explained = llm_classify(
+            dataframe=df[retry],
+            template=template,
+            model=model,
+            rails=rails,
+            provide_explanation=True,
+            concurrency=concurrency,
+        )
+        res.loc[explained.index, ["label", "explanation"]] = explained[["label", "explanation"]]
+    return res
+
+def classify_all(sql_df: pd.DataFrame, resp_df: pd.DataFrame, model, label_model=None,
+                 explain_failures_only: bool = False):
+    """
+    Grade both frames with ``model``. With ``explain_failures_only`` a
+    label-only first pass runs on ``label_model`` (default: ``model``),
+    typically the same model with a tight completion cap, and only the
+    rows that fail it are explained.
+
+    Call this on the main thread with no event loop running: that is the
+    only place llm_classify uses its async executor and honours
+    ``concurrency``; elsewhere it grades one row at a time.
+    """
+    _lazy_setup()
+    label_model = model if label_model is None else label_model
+    concurrency = int(os.getenv("PHOENIX_CONCURRENCY", "16"))
+    # SQL evaluation (Ollama only)
+    sql_res = _classify(
+        sql_df, SQL_GEN_EVAL_PROMPT_TEMPLATE, SQL_GEN_EVAL_PROMPT_RAILS_MAP,
+        model, label_model, concurrency, explain_failures_only,
+    )
+    # Response evaluation (Ollama only)
+    resp_res = _classify(
+        resp_df, QA_PROMPT_TEMPLATE, QA_PROMPT_RAILS_MAP,
+        model, label_model, concurrency, explain_failures_only,
+    )
+    return sql_res, resp_res
+
+
+def main():
+    """
+    Runs the eval cases through the pipeline, grades them with Phoenix,
+    prints the results, and writes the Excel report.
+    """
+    _lazy_setup()
+    eval_df = load_eval_cases()
+    # Only the pipeline step runs under an event loop; grading must happen
+    # after it has closed (see classify_all)
+    pred_df = asyncio.run(run_pipeline(eval_df))
+
+    # Prepare DataFrames for SQL correctness eval. Build them straight from
+    # the columns under their template names; select-then-rename copies twice.
+    sql_df = pd.DataFrame({
+        "instruction": pred_df["Question"],
+        "predicted_sql": pred_df["GeneratedSQL"],
+        "ground_truth_sql": pred_df["GroundTruthSQL"],
+    })
+    # Prepare DataFrames for response correctness eval
+    resp_df = pd.DataFrame({
+        "instruction": pred_df["Question"],
+        "predicted_response": pred_df["GeneratedResponse"],
+        "ground_truth_response": pred_df["GroundTruthResponse"],
+    })
+
+    # Ollama model only
+    # Label-only pass: the rail is a single word, so cap the completion hard.
+    # Only built when that pass runs.
+    explain_failures_only = os.getenv("EVAL_EXPLAIN_FAILURES_ONLY", "0") == "1"
+    label_model = _get_ollama_model(max_tokens=8) if explain_failures_only else None
+    sql_res_ollama, resp_res_ollama = classify_all(
+        sql_df, resp_df, _get_ollama_model(),
+        label_model=label_model, explain_failures_only=explain_failures_only,
     )
 
-print(f"\nExcel report saved to: {out_path}\n")
-```
+    # Merge labels back into pred_df in a single aligned concat
+    result_df = pd.concat(
+        [
+            pred_df.reset_index(drop=True),
+            sql_res_ollama[["label", "explanation"]].add_suffix("_sql_ollama").reset_index(drop=True),
+            resp_res_ollama[["label", "explanation"]].add_suffix("_resp_ollama").reset_index(drop=True),
+        ],
+        axis=1,
+    )
+
+    # === Step 3: Output ===
+    print("\n===== Detailed Evaluation Results (Ollama only) =====")
+    print(result_df.to_string(index=False))
+
+    # Aggregate metrics (Ollama only)
+    metrics = {}
+    metrics['Ollama SQL'] = sql_res_ollama.metrics()
+    metrics['Ollama Resp'] = resp_res_ollama.metrics()
+    print("\n===== Aggregate Metrics =====")
+    for key, met in metrics.items():
+        print(f"-- {key} --")
+        for k, v in met.items(): print(f"{k:30s}: {v}")
+        print()
+
+    # Excel export
+    out_path = os.path.join(os.path.dirname(__file__), "eval_results_ollama.xlsx")
+    with excel_writer(out_path) as writer:
+        write_sheet(writer, result_df, "Detailed")
+        summary_df = pd.concat(
+            [
+                pd.DataFrame({"Metric": [f"{key}: {k}" for k in met], "Value": list(met.values())})
+                for key, met in metrics.items()
+            ],
+            ignore_index=True,
+        )
+        write_sheet(writer, summary_df, "Summary")
+
+    print(f"\nExcel report saved to: {out_path}\n")
+
+    # The report now holds every prediction; drop the resume sidecar
+    os.remove(PREDICTIONS_PATH)
+
+
+if __name__ == "__main__":
+    main()
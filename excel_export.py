@@ -0,0 +1,37 @@
+# backend/app/services/excel_export.py
+
+import numbers
+
+import pandas as pd
+
+
+def excel_writer(path):
+    """
+    ExcelWriter on xlsxwriter in constant_memory mode, which flushes each
+    row to a temp file once the next one starts instead of holding every
+    cell in RAM until the workbook closes. Fill its sheets with write_sheet:
+    DataFrame.to_excel emits cells column by column, so in this mode it
+    would lose all but the last row.
+    """
+    return pd.ExcelWriter(
+        path,
+        engine="xlsxwriter",
+        engine_kwargs={"options": {"constant_memory": True}},
+    )
+
+
+def _excel_value(v):
+    """Coerce a cell to something xlsxwriter writes natively, as to_excel would."""
+    if isinstance(v, str) or (isinstance(v, numbers.Number) and not pd.isna(v)):
+        return v
+    if v is None or (pd.api.types.is_scalar(v) and pd.isna(v)):
+        return None
+    return str(v)
+
+
+def write_sheet(writer, df, sheet_name):
+    """Write ``df`` with its header to a new sheet of ``writer``, row by row."""
+    ws = writer.book.add_worksheet(sheet_name)
+    ws.write_row(0, 0, list(df.columns))
+    for r, row in enumerate(df.itertuples(index=False, name=None), start=1):
+        ws.write_row(r, 0, [_excel_value(v) for v in row])
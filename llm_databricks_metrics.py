@@ -1,11 +1,18 @@
 # backend/app/services/metrics.py
 
-import json
+import asyncio
+import io
+import numbers
+import os
+import sys
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta, timezone
 
-import numpy as np
+import orjson
 import pandas as pd
-from azure.cosmos import CosmosClient
+from azure.cosmos.aio import CosmosClient
+
+from services.excel_export import excel_writer, write_sheet
 
 # from utilities.constants import (
 #     AZURE_COSMOSDB_ENDPOINT,
@@ -15,21 +22,116 @@ from azure.cosmos import CosmosClient
 # )
 # Set env variables instead
 
-def fetch_weekly_items():
+TIMESTAMP_FIELDS = [
+    'timestamp_query_asked',
+    'timestamp_query_generated',
+    'timestamp_query_executed',
+]
+
+SUMMARY_FIELDS = ['userId', 'status']
+
+DOCUMENT_FIELDS = [
+    'userId',
+    'user_context',
+    'user_question',
+    'generated_sql_query',
+    'error',
+    'status',
+    *TIMESTAMP_FIELDS,
+]
+
+
+@asynccontextmanager
+async def _conversations_container():
+    # Comma-separated regions, nearest first, e.g. "West Europe,North Europe".
+    # Left out when unset: the SDK iterates it on failover, so an explicit
+    # None would mask the real connection error with a TypeError.
+    regions = os.getenv("AZURE_COSMOSDB_PREFERRED_LOCATIONS")
+    kwargs = {"preferred_locations": [r.strip() for r in regions.split(",")]} if regions else {}
+    async with CosmosClient(
+        AZURE_COSMOSDB_ENDPOINT,
+        AZURE_COSMOSDB_ACCOUNT_KEY,
+        **kwargs,
+    ) as client:
+        database = client.get_database_client(AZURE_COSMOSDB_DATABASE)
+        yield database.get_container_client(AZURE_COSMOSDB_CONVERSATIONS_CONTAINER)
+
+
+# Every query below filters on c.timestamp_query_asked >= @start (and the
+# capped details query orders by it). That is only an index seek if the
+# container's indexing policy keeps a range index on the property; with a
+# policy that excludes it, Cosmos scans every document in every partition.
+# The default "index everything" policy covers it. A trimmed policy must
+# keep at least:
+#
+#     {"indexingMode": "consistent",
+#      "includedPaths": [{"path": "/timestamp_query_asked/?"}, ...],
+#      "excludedPaths": [{"path": "/*"}]}
+#
+# Queries stay cross-partition: none of the weekly reports can supply a
+# partition key value.
+def _week_start_params():
+    week_ago = datetime.now(timezone.utc) - timedelta(days=7)
+    return [{"name": "@start", "value": week_ago.isoformat()}]
+
+
+async def _query(container, query, params):
+    # max_item_count=-1 lets the service pick the page size, so a week of
+    # documents comes back in fewer, larger round trips; pages are drained
+    # as their continuation tokens resolve. Queries are cross-partition by
+    # default on the async client.
+    docs = []
+    pages = container.query_items(
+        query=query,
+        parameters=params,
+        max_item_count=-1,
+    ).by_page()
+    async for page in pages:
+        docs.extend([doc async for doc in page])
+    return docs
+
+
+async def _scalar(container, query, params):
+    # SELECT VALUE aggregates come back as one value (none if nothing matched)
+    rows = await _query(container, query, params)
+    return rows[0] if rows else 0
+
+
+async def fetch_weekly_summary_async(container):
     """
-    Pull all conversation-history documents from the last 7 days with
-    the fields needed for metrics.
+    Totals for the last 7 days without the document payloads, so they stay
+    exact when the details are fetched with a limit: the userId and status
+    of every query, and latency sums over the ``timed_n`` queries that have
+    all three timestamps. The SDK can't run GROUP BY across partitions, so
+    the small status rows are counted client-side and the latencies use
+    scalar SELECT VALUE aggregates, which it does merge. DateTimeDiff is
+    undefined for timestamps that aren't in Cosmos' UTC "...Z" format, so
+    such queries are left out of the latency sums.
     """
-    client    = CosmosClient(AZURE_COSMOSDB_ENDPOINT, AZURE_COSMOSDB_ACCOUNT_KEY)
-    database  = client.get_database_client(AZURE_COSMOSDB_DATABASE)
-    container = database.get_container_client(AZURE_COSMOSDB_CONVERSATIONS_CONTAINER)
+    llm = 'DateTimeDiff("ms", c.timestamp_query_asked, c.timestamp_query_generated)'
+    db  = 'DateTimeDiff("ms", c.timestamp_query_generated, c.timestamp_query_executed)'
+    week  = "c.timestamp_query_asked >= @start"
+    timed = f"{week} AND IS_DEFINED({llm}) AND IS_DEFINED({db})"
+    params = _week_start_params()
+    queries, timed_n, llm_ms, db_ms = await asyncio.gather(
+        _query(container, f"SELECT c.userId, c.status FROM c WHERE {week}", params),
+        _scalar(container, f"SELECT VALUE COUNT(1) FROM c WHERE {timed}", params),
+        _scalar(container, f"SELECT VALUE SUM({llm}) FROM c WHERE {timed}", params),
+        _scalar(container, f"SELECT VALUE SUM({db}) FROM c WHERE {timed}", params),
+    )
+    return {'queries': queries, 'timed_n': timed_n, 'llm_ms': llm_ms, 'db_ms': db_ms}
 
-    now      = datetime.now(timezone.utc)
-    week_ago = now - timedelta(days=7)
-    start_iso = week_ago.isoformat()
 
-    query = """
-      SELECT
+async def fetch_weekly_items_async(container, limit=None):
+    """
+    Pull conversation-history documents from the last 7 days with the
+    fields needed for metrics. With ``limit``, only the most recent
+    ``limit`` documents are returned.
+    """
+    top = "TOP @limit" if limit else ""
+    order = "ORDER BY c.timestamp_query_asked DESC" if limit else ""
+    query = f"""
+      SELECT {top}
         c.id,
         c.userId,
         c.user_context,
@@ -43,44 +145,92 @@ def fetch_weekly_items():
         c.timestamp_query_executed
       FROM c
       WHERE c.timestamp_query_asked >= @start
+      {order}
     """
-    params = [{"name": "@start", "value": start_iso}]
+    params = _week_start_params()
+    if limit:
+        params.append({"name": "@limit", "value": limit})
+    return await _query(container, query, params)
 
-    return list(container.query_items(
-        query=query,
-        parameters=params,
-        enable_cross_partition_query=True
-    ))
+
+async def fetch_weekly_async(limit=None):
+    """
+    Return ``(summary, items)``. The summary is only needed, and only
+    fetched, when ``limit`` caps the items; it then runs concurrently with
+    the detail query on the same client. Uncapped, the items already cover
+    every query and ``summary`` is None.
+    """
+    async with _conversations_container() as container:
+        if not limit:
+            return None, await fetch_weekly_items_async(container)
+        return await asyncio.gather(
+            fetch_weekly_summary_async(container),
+            fetch_weekly_items_async(container, limit),
+        )
+
+
+async def _with_container(fetch, *args):
+    async with _conversations_container() as container:
+        return await fetch(container, *args)
+
+
+def fetch_weekly_summary():
+    """Synchronous wrapper around fetch_weekly_summary_async."""
+    return asyncio.run(_with_container(fetch_weekly_summary_async))
+
+
+def fetch_weekly_items(limit=None):
+    """Synchronous wrapper around fetch_weekly_items_async."""
+    return asyncio.run(_with_container(fetch_weekly_items_async, limit))
+
+
+def _dumps(obj):
+    # orjson emits UTF-8 directly (the ensure_ascii=False behaviour) and is
+    # several times faster than json.dumps on large result payloads
+    return orjson.dumps(obj).decode('utf-8')
 
 
-def compute_metrics(items):
+def _documents_frame(items):
     """
-    Compute summary metrics and per-user counts from fetched documents.
+    Columnar view of the documents, with per-query latencies in ms. Each
+    timestamp column is parsed in one vectorized pass; if any of a query's
+    timestamps is missing or malformed, both its latencies are NaN.
     """
-    total     = len(items)
-    successes = sum(1 for d in items if d.get('status') == 'Success')
-    failures  = total - successes
-    success_rate = round(successes / total * 100, 2) if total else 0
+    df = pd.DataFrame.from_records(items, columns=DOCUMENT_FIELDS)
+    t0, t1, t2 = (
+        pd.to_datetime(df[col], utc=True, format='ISO8601', errors='coerce')
+        for col in TIMESTAMP_FIELDS
+    )
+    timed = t0.notna() & t1.notna() & t2.notna()
+    df['llm_ms'] = ((t1 - t0).dt.total_seconds() * 1000).where(timed)
+    df['db_ms']  = ((t2 - t1).dt.total_seconds() * 1000).where(timed)
+    return df
 
-    llm_times = []
-    db_times  = []
 
-    for d in items:
-        try:
-            t0 = datetime.fromisoformat(d['timestamp_query_asked'])
-            t1 = datetime.fromisoformat(d['timestamp_query_generated'])
-            t2 = datetime.fromisoformat(d['timestamp_query_executed'])
-            llm_times.append((t1 - t0).total_seconds() * 1000)
-            db_times.append((t2 - t1).total_seconds() * 1000)
-        except Exception:
-            continue
+def _metrics_from_frame(df, summary=None):
+    # (userId, status) of every query, either from the summary or the frame
+    if summary is None:
+        queries = df[SUMMARY_FIELDS]
+    else:
+        queries = pd.DataFrame.from_records(summary['queries'], columns=SUMMARY_FIELDS)
 
-    avg_llm = round(np.mean(llm_times), 2) if llm_times else None
-    avg_db  = round(np.mean(db_times),  2) if db_times  else None
+    total     = len(queries)
+    successes = int(queries['status'].eq('Success').sum())
+    failures  = total - successes
+    success_rate = round(successes / total * 100, 2) if total else 0
 
-    # per-user query counts
-    users = [d.get('userId', '') for d in items]
-    user_counts = pd.Series(users).value_counts().to_dict()
+    # When the documents are capped they are only a sample, so prefer the
+    # server-side latency sums, which cover every timed query
+    if summary is not None and len(df) < total and summary['timed_n']:
+        avg_llm = round(summary['llm_ms'] / summary['timed_n'], 2)
+        avg_db  = round(summary['db_ms'] / summary['timed_n'], 2)
+    else:
+        timed   = df['llm_ms'].notna().any()
+        avg_llm = round(float(df['llm_ms'].mean()), 2) if timed else None
+        avg_db  = round(float(df['db_ms'].mean()),  2) if timed else None
+
+    # per-user query counts, most active first
+    user_counts = queries['userId'].fillna('').value_counts().to_dict()
 
     return {
         'total_queries': total,
@@ -93,24 +243,96 @@ def compute_metrics(items):
     }
 
 
+def compute_metrics(items, summary=None):
+    """
+    Compute summary metrics and per-user counts from fetched documents.
+    When ``summary`` (from fetch_weekly_summary) is given, query and
+    per-user counts come from it, so they stay exact even if ``items`` was
+    fetched with a limit; so do latencies, if ``items`` was in fact capped.
+    """
+    return _metrics_from_frame(_documents_frame(items), summary)
+
+
+def compute_metrics_and_details(items, summary=None):
+    """
+    Like compute_metrics, but also return a per-query details DataFrame
+    built from the same parsed frame, so the timestamps are parsed once.
+    """
+    df = _documents_frame(items)
+    details = pd.DataFrame({
+        'UserId': df['userId'],
+        'UserContext': df['user_context'],
+        'UserQuestion': df['user_question'],
+        'GeneratedSQL': df['generated_sql_query'],
+        'LLM Latency (ms)': df['llm_ms'].round(2),
+        'DB Latency (ms)': df['db_ms'].round(2),
+        'DatabaseResponse': [
+            _dumps(d.get('database_response')) for d in items
+        ],
+        'Error': df['error'],
+        'Status': df['status'],
+    })
+    # Missing fields read as None, like dict.get, rather than NaN
+    details = details.astype(object).where(details.notna(), None)
+    return _metrics_from_frame(df, summary), details
+
+
+def _parquet_value(v):
+    # Nested values (e.g. a dict user_context) become JSON text so every
+    # column has a single Arrow type
+    if v is None or isinstance(v, (str, numbers.Number)):
+        return v
+    return _dumps(v)
+
+
+def write_parquet(df, path):
+    """
+    Write ``df`` as a zstd-compressed Parquet file for machine consumers,
+    which can then skip the Excel round trip and load it with
+    pd.read_parquet.
+    """
+    df = df.apply(lambda col: col.map(_parquet_value) if col.dtype == object else col)
+    df.to_parquet(path, engine='pyarrow', compression='zstd', index=False)
+
+
+SUMMARY_TEMPLATE = """
+===== Weekly Metrics Summary =====
+Date Range          : {date_range}
+Total Queries       : {total_queries}
+Successful Queries  : {successful_queries}
+Failed Queries      : {failed_queries}
+Success Rate (%)    : {success_rate_pct}
+Avg LLM Latency (ms): {avg_llm_latency_ms}
+Avg DB Latency (ms) : {avg_db_latency_ms}
+===================================
+"""
+
+
+def _fmt_ms(value):
+    return 'N/A' if value is None else f'{value:.2f}'
+
+
 def generate_report():
     """
     Fetches data, computes metrics, prints to console, and writes Excel.
     """
     now     = datetime.now(timezone.utc)
-    items   = fetch_weekly_items()
-    metrics = compute_metrics(items)
-
-    # Build terminal summary
-    print("\n===== Weekly Metrics Summary =====")
-    print(f"Date Range          : {(now - timedelta(days=7)).date()} → {now.date()}")
-    print(f"Total Queries       : {metrics['total_queries']}")
-    print(f"Successful Queries  : {metrics['successful_queries']}")
-    print(f"Failed Queries      : {metrics['failed_queries']}")
-    print(f"Success Rate (%)    : {metrics['success_rate_pct']}")
-    print(f"Avg LLM Latency (ms): {metrics['avg_llm_latency_ms']}")
-    print(f"Avg DB Latency (ms) : {metrics['avg_db_latency_ms']}")
-    print("===================================\n")
+    # Optional cap on the detail rows; totals still come from the summary.
+    # Parsed before any client is opened; 0 or less means no cap.
+    limit = int(os.getenv("METRICS_DETAILS_LIMIT", "0"))
+    summary, items = asyncio.run(fetch_weekly_async(limit=limit if limit > 0 else None))
+    metrics, details_df = compute_metrics_and_details(items, summary)
+
+    date_range = f"{(now - timedelta(days=7)).date()} → {now.date()}"
+
+    # Build terminal summary; latencies are None when no query had all
+    # three timestamps, so format them up front rather than in the template
+    print(SUMMARY_TEMPLATE.format_map({
+        **metrics,
+        'date_range': date_range,
+        'avg_llm_latency_ms': _fmt_ms(metrics['avg_llm_latency_ms']),
+        'avg_db_latency_ms': _fmt_ms(metrics['avg_db_latency_ms']),
+    }))
 
     # Queries per user
     print("===== Queries per User =====")
@@ -118,46 +340,28 @@ def generate_report():
         print(f"{user:30s} : {count}")
     print()
 
-    # Full query details with user_context, latencies, error
-    print("===== All Query Details =====")
-    detailed_rows = []
-    for d in items:
-        # calculate latencies per record
-        try:
-            t0 = datetime.fromisoformat(d['timestamp_query_asked'])
-            t1 = datetime.fromisoformat(d['timestamp_query_generated'])
-            t2 = datetime.fromisoformat(d['timestamp_query_executed'])
-            llm_ms = round((t1 - t0).total_seconds() * 1000, 2)
-            db_ms  = round((t2 - t1).total_seconds() * 1000, 2)
-        except Exception:
-            llm_ms = db_ms = None
-
-        detailed_rows.append({
-            'UserId': d.get('userId'),
-            'UserContext': d.get('user_context'),
-            'UserQuestion': d.get('user_question'),
-            'GeneratedSQL': d.get('generated_sql_query'),
-            'LLM Latency (ms)': llm_ms,
-            'DB Latency (ms)': db_ms,
-            'DatabaseResponse': json.dumps(d.get('database_response'), ensure_ascii=False),
-            'Error': d.get('error'),
-            'Status': d.get('status'),
-        })
-
-        # print to console
-        print(f"UserId          : {d.get('userId')}")
-        print(f"UserContext     : {d.get('user_context')}")
-        print(f"Question        : {d.get('user_question')}")
-        print(f"GeneratedSQL    : {d.get('generated_sql_query')}")
-        print(f"LLM Latency (ms): {llm_ms}")
-        print(f"DB Latency (ms) : {db_ms}")
-        print(f"Status / Error  : {d.get('status')} / {d.get('error')}")
-        print(f"Response        : {json.dumps(d.get('database_response'), ensure_ascii=False)}")
-        print("-" * 60)
+    # Full query details with user_context, latencies, error. They are all
+    # in the AllQueries sheet, so only echo them with METRICS_VERBOSE=1, and
+    # buffer the output into one write instead of nine print calls per query.
+    if os.getenv("METRICS_VERBOSE", "0") == "1":
+        buf = io.StringIO()
+        buf.write("===== All Query Details =====\n")
+        for (user_id, user_ctx, question, sql, llm_ms, db_ms,
+             response, error, status) in details_df.itertuples(index=False, name=None):
+            buf.write(f"UserId          : {user_id}\n")
+            buf.write(f"UserContext     : {user_ctx}\n")
+            buf.write(f"Question        : {question}\n")
+            buf.write(f"GeneratedSQL    : {sql}\n")
+            buf.write(f"LLM Latency (ms): {llm_ms}\n")
+            buf.write(f"DB Latency (ms) : {db_ms}\n")
+            buf.write(f"Status / Error  : {status} / {error}\n")
+            buf.write(f"Response        : {response}\n")
+            buf.write("-" * 60 + "\n")
+        sys.stdout.write(buf.getvalue())
 
     # Prepare DataFrames for Excel
     summary_df = pd.DataFrame([
-        ("Date Range",          f"{(now - timedelta(days=7)).date()} → {now.date()}"),
+        ("Date Range",          date_range),
         ("Total Queries",       metrics['total_queries']),
         ("Successful Queries",  metrics['successful_queries']),
         ("Failed Queries",      metrics['failed_queries']),
@@ -171,17 +375,37 @@ def generate_report():
         columns=["UserId", "Queries"]
     )
 
-    details_df = pd.DataFrame(detailed_rows)
-
     # Write to Excel
     excel_path = "weekly_metrics_detailed.xlsx"
-    with pd.ExcelWriter(excel_path, engine="openpyxl") as writer:
-        summary_df.to_excel(writer, sheet_name="Summary", index=False)
-        user_counts_df.to_excel(writer, sheet_name="UserCounts", index=False)
-        details_df.to_excel(writer, sheet_name="AllQueries", index=False)
+    with excel_writer(excel_path) as writer:
+        write_sheet(writer, summary_df, "Summary")
+        write_sheet(writer, user_counts_df, "UserCounts")
+        write_sheet(writer, details_df, "AllQueries")
 
     print(f"\nExcel report saved to: {excel_path}\n")
 
+    # Parquet siblings of the sheets for dashboards and other pipelines.
+    # The summary goes out as one typed row rather than the Metric/Value
+    # pairs, whose Value column mixes text and numbers. Its dtypes are pinned
+    # so an empty week (integer 0 rate, None latencies) keeps the same
+    # schema and weekly files concatenate cleanly.
+    if os.getenv("METRICS_PARQUET", "0") == "1":
+        summary_row = {k: v for k, v in metrics.items() if k != 'user_counts'}
+        write_parquet(
+            pd.DataFrame([{'date_range': date_range, **summary_row}]).astype({
+                'total_queries': 'int64',
+                'successful_queries': 'int64',
+                'failed_queries': 'int64',
+                'success_rate_pct': 'float64',
+                'avg_llm_latency_ms': 'float64',
+                'avg_db_latency_ms': 'float64',
+            }),
+            "weekly_metrics_summary.parquet",
+        )
+        write_parquet(user_counts_df, "weekly_metrics_user_counts.parquet")
+        write_parquet(details_df, "weekly_metrics_queries.parquet")
+        print("Parquet report saved to: weekly_metrics_*.parquet\n")
+
 
 if __name__ == "__main__":
     generate_report()
@@ -1,12 +1,35 @@
 # services/pipeline_service.py
 
+import asyncio
+import os
+
 from services.sql_generation import get_completion_from_messages
 from services.query_execution import execute_sql
 from services.refiner_service import refine_sql
 
+def _discard(task):
+    """Cancel a speculative task whose result is no longer needed."""
+    task.cancel()
+    # Retrieve a failure that raced the cancel so asyncio doesn't log it
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
 async def generate_refine_execute(question: str) -> dict:
     # 1) First‐pass SQL
     initial_sql = await get_completion_from_messages(system_message, question)
+    if os.getenv("PIPELINE_SPECULATIVE_REFINE", "0") != "1":
+        return await _execute_or_refine(initial_sql, lambda: refine_sql(initial_sql, question))
+    # Opt-in: the refiner only needs the SQL and the question, not the
+    # execution error, so start it now and let it run under the first
+    # execution. Queries that succeed first time still pay for a (cancelled)
+    # refiner call, so this trades LLM spend for failure-path latency.
+    refine_task = asyncio.create_task(refine_sql(initial_sql, question))
+    try:
+        return await _execute_or_refine(initial_sql, lambda: refine_task)
+    finally:
+        # No-op once awaited; cancels it on success or if we're cancelled
+        _discard(refine_task)
+
+async def _execute_or_refine(initial_sql, refine):
     # 2) Try to run it
     try:
         result = await execute_sql(initial_sql)
@@ -19,8 +42,8 @@ async def generate_refine_execute(question: str) -> dict:
           "rows": result,
         }
     except Exception as err:
-        # 3) On error, call the refiner
-        refined_sql = await refine_sql(initial_sql, question)
+        # 3) On error, call the refiner (or take its speculative output)
+        refined_sql = await refine()
         # 4) Try again
         try:
             result = await execute_sql(refined_sql)